@@ -0,0 +1,16 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def compute_orders(
+    shares: np.ndarray, prices: np.ndarray, target_weights: np.ndarray, cash: float
+) -> np.ndarray:
+    total = cash
+    for i in range(shares.shape[0]):
+        total += shares[i] * prices[i]
+    orders = np.empty(shares.shape[0], dtype=np.float64)
+    for i in range(shares.shape[0]):
+        weight = shares[i] * prices[i] / total
+        orders[i] = (target_weights[i] - weight) * total / prices[i]
+    return np.round(orders)
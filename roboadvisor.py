@@ -1,21 +1,23 @@
 import argparse
 import csv
+import logging
 import math
-import random
 import time
 from dataclasses import dataclass
 from typing import List, Dict, Any, Union
 import ib_insync as ibi
+import numpy as np
 
+log = logging.getLogger(__name__)
 
-@dataclass
+@dataclass(slots=True)
 class Investment:
     stock: ibi.Stock
     allocation: float
     num_shares: float = None
     market_price: float = None
     exact_shares_to_purchase: float = None
-    shares_to_purchase: int = None
+    shares_to_purchase: float = None
 
 
 class MarketDataGetter:
@@ -25,15 +27,27 @@ class MarketDataGetter:
             raise ValueError("Must be connected")
 
     def get_market_value(self, symbol: str, timeout: float = 10):
-        stock = ibi.Stock(symbol, exchange="SMART", currency="USD")
-        ticker = self.connector.reqMktData(stock, "", False, False)
+        return self.get_market_values([symbol], timeout=timeout)[symbol]
+
+    def get_market_values(self, symbols: List[str], timeout: float = 10) -> Dict[str, float]:
+        pending = {}
+        for symbol in symbols:
+            stock = ibi.Stock(symbol, exchange="SMART", currency="USD")
+            pending[symbol] = self.connector.reqMktData(stock, "", False, False)
+        prices = {}
         s = time.time()
-        while math.isnan(ticker.marketPrice()) and math.isnan(ticker.last):
-            if 0 < timeout <= time.time() - s:
-                raise ValueError(f"Took to long to get data for symbol {symbol}")
-            self.connector.sleep(0.5)
-            ticker = self.connector.ticker(stock)
-        return ticker.marketPrice()
+        while True:
+            for symbol, ticker in list(pending.items()):
+                if not (math.isnan(ticker.marketPrice()) and math.isnan(ticker.last)):
+                    prices[symbol] = ticker.marketPrice()
+                    del pending[symbol]
+            if not pending:
+                return prices
+            elapsed = time.time() - s
+            if 0 < timeout <= elapsed:
+                raise ValueError(f"Took to long to get data for symbols {list(pending)}")
+            # wakes on the next tick instead of sleeping a fixed interval
+            self.connector.waitOnUpdate(timeout=timeout - elapsed if timeout > 0 else 0)
 
 
 class CurrentPortfolio:
@@ -42,21 +56,23 @@ class CurrentPortfolio:
         if self.connector.isConnected() is False:
             raise ValueError("Must be connected")
         self.portfolio = self.get_portfolio()
+        # options are listed under their underlying's symbol, so only index stocks
+        self._by_symbol = {}
+        for item in self.portfolio:
+            if item.contract.secType == "STK":
+                self._by_symbol.setdefault(item.contract.symbol, item)
 
     def get_portfolio(self) -> List[ibi.PortfolioItem]:
         return self.connector.portfolio()
 
     def contains(self, symbol):
-        for item in self.portfolio:
-            if item.contract.symbol == symbol:
-                return True
-        return False
+        return symbol in self._by_symbol
 
     def get(self, symbol: str) -> ibi.PortfolioItem:
-        for item in self.portfolio:
-            if item.contract.symbol == symbol:
-                return item
-        raise KeyError(f"{symbol} not currently in portfolio")
+        item = self._by_symbol.get(symbol)
+        if item is None:
+            raise KeyError(f"{symbol} not currently in portfolio")
+        return item
 
 
 class AccountInfo:
@@ -64,29 +80,28 @@ class AccountInfo:
         self.connector = connector
 
     def available_cash(self, currency: str = "USD"):
-        print([
-            f"{v.value} {v.currency}"
-            for v in self.connector.accountValues()
-            if v.tag == "AvailableFunds"
-        ])
-        funds = [
-            float(v.value)
-            for v in self.connector.accountValues()
-            if v.tag == "AvailableFunds" and v.currency == currency
-        ][0]
-        return funds
+        account_values = self.connector.accountValues()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Available funds: %s",
+                [f"{v.value} {v.currency}" for v in account_values if v.tag == "AvailableFunds"],
+            )
+        for v in account_values:
+            if v.tag == "AvailableFunds" and v.currency == currency:
+                return float(v.value)
+        raise ValueError(f"No available funds reported in {currency}")
 
 
 class Plan:
+    MAX_KNAPSACK_INVESTMENTS = 20
+
     def __init__(self, investments: List[Investment]):
         self.investments = investments
         self.validate_allocations()
 
     def validate_allocations(self):
-        total_allocation = sum(
-            [investment.allocation for investment in self.investments]
-        )
-        if total_allocation != 1.0:
+        total_allocation = math.fsum(investment.allocation for investment in self.investments)
+        if not math.isclose(total_allocation, 1.0, abs_tol=1e-9):
             raise ValueError(f"Total allocation sum to 1: {total_allocation:0.4f}")
 
     def calculate_total_stock_value(self):
@@ -98,63 +113,112 @@ class Plan:
         total = stock_value + available_cash
         return total
 
-    def calculate_shares_to_purchase(self, available_cash: float):
+    def calculate_shares_to_purchase(self, available_cash: float, leftover: bool = True):
+        # prices and holdings are only known once the plan has been completed
+        count = len(self.investments)
+        allocations = np.fromiter((i.allocation for i in self.investments), dtype=np.float64, count=count)
+        prices = np.fromiter((i.market_price for i in self.investments), dtype=np.float64, count=count)
+        num_shares = np.fromiter((i.num_shares for i in self.investments), dtype=np.float64, count=count)
+        if not (np.isfinite(prices).all() and (prices > 0).all()):
+            invalid = [i.stock.symbol for i in self.investments if not (math.isfinite(i.market_price) and i.market_price > 0)]
+            raise ValueError(f"Invalid market price for {invalid}")
         total_value = self.calculate_total_value(available_cash)
-        money_left = 0.0
-        for investment in self.investments:
-            desired_value = investment.allocation * total_value
-            desired_num_shares = desired_value / investment.market_price
-            current_num_shares = investment.num_shares
-            investment.exact_shares_to_purchase = desired_num_shares - current_num_shares
-            investment.shares_to_purchase = int(math.floor(investment.exact_shares_to_purchase))
-            money_left += investment.market_price * (investment.exact_shares_to_purchase - investment.shares_to_purchase)
-        self.calculate_leftover_shares_to_purchase(money_left)
+        exact_shares = allocations * total_value / prices - num_shares
+        shares = np.floor(exact_shares)
+        money_left = float((prices * (exact_shares - shares)).sum())
+        for investment, exact, whole in zip(self.investments, exact_shares.tolist(), shares.astype(np.int64).tolist()):
+            investment.exact_shares_to_purchase = exact
+            investment.shares_to_purchase = whole
+        if leftover is True:
+            self.calculate_leftover_shares_to_purchase(money_left)
+        else:
+            # without leftover allocation, report the exact fractional share counts
+            for investment in self.investments:
+                investment.shares_to_purchase = investment.exact_shares_to_purchase
         return self.investments
 
-    def calculate_leftover_shares_to_purchase(self, money_left: float, randomly: bool = True):
-        idxs = list(range(len(self.investments)))
-        if randomly is True:
-            random.shuffle(idxs)
-        for idx in idxs:
-            investment = self.investments[idx]
-            if investment.market_price <= money_left:
-                investment.shares_to_purchase += 1
-                money_left -= investment.market_price 
+    def calculate_leftover_shares_to_purchase(self, money_left: float):
+        # largest fractional deficit first, so ties favor the most underweight investments
+        candidates = sorted(
+            (
+                investment
+                for investment in self.investments
+                if investment.exact_shares_to_purchase - investment.shares_to_purchase > 0
+            ),
+            key=lambda i: i.exact_shares_to_purchase - i.shares_to_purchase,
+            reverse=True,
+        )
+        if len(candidates) <= self.MAX_KNAPSACK_INVESTMENTS:
+            chosen = self._choose_leftover_shares_exactly(candidates, money_left)
+        else:
+            chosen = self._choose_leftover_shares_greedily(candidates, money_left)
+        for investment in chosen:
+            investment.shares_to_purchase += 1
         return self.investments
 
+    @staticmethod
+    def _choose_leftover_shares_greedily(candidates: List[Investment], money_left: float) -> List[Investment]:
+        chosen = []
+        for investment in candidates:
+            if investment.market_price <= money_left:
+                chosen.append(investment)
+                money_left -= investment.market_price
+        return chosen
+
+    @staticmethod
+    def _choose_leftover_shares_exactly(candidates: List[Investment], money_left: float) -> List[Investment]:
+        # 0/1 knapsack over "buy one more share" choices, maximizing the cents spent
+        capacity = int(math.floor(money_left * 100 + 1e-6))
+        reachable = {0: None}
+        for idx, investment in enumerate(candidates):
+            cost = int(round(investment.market_price * 100))
+            for spent in list(reachable):
+                total = spent + cost
+                if total <= capacity and total not in reachable:
+                    reachable[total] = (spent, idx)
+        chosen = []
+        spent = max(reachable)
+        while reachable[spent] is not None:
+            spent, idx = reachable[spent]
+            chosen.append(candidates[idx])
+        return chosen
 
 
 class PlanReader:
     @classmethod
     def read_plan(cls, path: str) -> Plan:
-        rows = cls._load_file(path)
-        investments = []
-        for row in rows:
-            stock = ibi.Stock(symbol=row["stock"], exchange="SMART", currency="USD")
-            allocation = float(row["allocation"])
-            investments.append(Investment(stock, allocation))
+        with open(path, newline="") as f:
+            investments = [
+                Investment(
+                    ibi.Stock(symbol=row["stock"], exchange="SMART", currency="USD"),
+                    float(row["allocation"]),
+                )
+                for row in csv.DictReader(f)
+            ]
         return Plan(investments)
 
-    @classmethod
-    def _load_file(cls, path: str) -> List[Dict[Any, Any]]:
-        with open(path) as f:
-            dr = csv.DictReader(f)
-            return [row for row in dr]
-
 
 class PlanCompleter:
     def __init__(self, connector: ibi.IB):
         self.connector = connector
 
     def complete_plan(self, plan: Plan, portfolio: CurrentPortfolio) -> Plan:
+        missing = [
+            investment.stock.symbol
+            for investment in plan.investments
+            if not portfolio.contains(investment.stock.symbol)
+        ]
+        market_values = {}
+        if len(missing) > 0:
+            data_getter = MarketDataGetter(connector=self.connector)
+            market_values = data_getter.get_market_values(missing)
         for investment in plan.investments:
             if portfolio.contains(investment.stock.symbol):
                 portfolio_item = portfolio.get(investment.stock.symbol)
                 market_price = portfolio_item.marketPrice
                 num_shares = portfolio_item.position
             else:
-                data_getter = MarketDataGetter(connector=self.connector)
-                market_price = data_getter.get_market_value(investment.stock.symbol)
+                market_price = market_values[investment.stock.symbol]
                 num_shares = 0
             investment.market_price = market_price
             investment.num_shares = num_shares
@@ -165,11 +229,15 @@ class OrderMaker:
     def __init__(self, connector: ibi.IB):
         self.connector = connector
 
+    def qualify_all(self, investments: List[Investment]) -> List[ibi.Contract]:
+        return self.connector.qualifyContracts(*[investment.stock for investment in investments])
+
     def order(
         self, investment: Investment, test: bool = True, num_shares: float = None
     ) -> Union[ibi.Trade, ibi.OrderState]:
         contract = investment.stock
-        self.connector.qualifyContracts(contract)
+        if not contract.conId:
+            self.connector.qualifyContracts(contract)
         if num_shares is None:
             num_shares = math.floor(investment.shares_to_purchase)
         order = ibi.MarketOrder(action="BUY", totalQuantity=num_shares)
@@ -186,6 +254,11 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
+    # only this module's messages are shown; ib_insync's own INFO logging stays quiet
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
     do_order = args.order
     port = args.port
     ib = ibi.IB()
@@ -194,12 +267,14 @@ if __name__ == "__main__":
     plan = PlanReader.read_plan("config/plan.csv")
     plan = PlanCompleter(ib).complete_plan(plan=plan, portfolio=portfolio)
     available_cash = AccountInfo(connector=ib).available_cash()
-    print(f"You have ${available_cash:03f}")
+    log.info("You have $%.3f", available_cash)
     investments = plan.calculate_shares_to_purchase(available_cash)
 
     order_maker = OrderMaker(ib)
+    if do_order is True:
+        order_maker.qualify_all(investments)
     for investment in investments:
-        print(investment)
+        log.info("%s", investment)
 
         if do_order is True:
             order_maker.order(investment, test=False)
@@ -1,20 +1,80 @@
 # coding: utf-8
 
 from dataclasses import dataclass
+import asyncio
+import functools
 import time
 import json
 import requests
+import aiohttp
 import logging
 import pathlib
 import urllib3
 
 from typing import Dict
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import InsecureRequestWarning
 
 urllib3.disable_warnings(category=InsecureRequestWarning)
 
 
-class IBKRSession:
+class _IBKRSessionBase:
+    """URL building and response handling shared by the sync and async sessions."""
+
+    def __init__(self, url: str = "https://localhost:5000/v1/api/") -> None:
+        self.resource_url = url
+        # conids whose market data snapshot subscription has been started on this gateway
+        self.warmed_conids = set()
+
+    def build_url(self, endpoint: str) -> str:
+        url = self.resource_url + endpoint
+        return url
+
+    @staticmethod
+    def _log_request(method: str, url: str, json_payload: dict = None) -> None:
+        logging.info(msg="------------------------")
+        logging.info(msg=f"Request Method: {method}")
+        logging.info(msg="URL: {url}".format(url=url))
+        logging.info(msg=f"JSON Payload: {json_payload}")
+
+    @staticmethod
+    def _handle_response(
+        ok: bool,
+        status_code: int,
+        reason: str,
+        url: str,
+        content: str,
+        request_headers: dict,
+        request_method: str,
+    ) -> Dict:
+        logging.info(msg=f"Response Status Code: {status_code}")
+        logging.info(msg=f"Response Content: {content}")
+
+        if ok and len(content) > 0:
+            return json.loads(content)
+        elif not ok:
+            if len(content) == 0:
+                response_data = ""
+            else:
+                try:
+                    response_data = json.loads(content)
+                except ValueError:
+                    response_data = content
+
+            error_dict = {
+                "error_code": status_code,
+                "error_reason": reason,
+                "response_url": url,
+                "response_body": response_data,
+                "response_request": request_headers,
+                "response_method": request_method,
+            }
+
+            logging.error(msg=json.dumps(obj=error_dict, indent=4))
+            return error_dict
+
+
+class IBKRSession(_IBKRSessionBase):
     """Serves as the Session for the Interactive Brokers API."""
 
     def __init__(self, url: str = "https://localhost:5000/v1/api/") -> None:
@@ -34,11 +94,24 @@ class IBKRSession:
         ----
             >>> ib_session = InteractiveBrokersSession()
         """
-        self.resource_url = url
-
-    def build_url(self, endpoint: str) -> str:
-        url = self.resource_url + endpoint
-        return url
+        super().__init__(url)
+        self._session = requests.Session()
+        self._session.verify = False
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+        self._session.mount("https://", adapter)
+        self._session_methods = {
+            "get": self._session.get,
+            "post": self._session.post,
+            "delete": self._session.delete,
+        }
+        self._async_session = None
+
+    @property
+    def async_session(self) -> "AsyncIBKRSession":
+        """The `AsyncIBKRSession` for the same API, shared by everything using this session."""
+        if self._async_session is None:
+            self._async_session = AsyncIBKRSession(url=self.resource_url)
+        return self._async_session
 
     def get(self, endpoint: str, params: dict = None) -> Dict:
         return self.make_request("get", endpoint=endpoint, params=params)
@@ -85,57 +158,134 @@ class IBKRSession:
         """
 
         url = self.build_url(endpoint=endpoint)
-        logging.info(msg="------------------------")
-        logging.info(msg=f"Request Method: {method}")
-        logging.info(msg="URL: {url}".format(url=url))
-        logging.info(msg=f"JSON Payload: {json_payload}")
-        if method == "post":
-            response = requests.post(url=url, params=params, json=json_payload, verify=False)
-        elif method == "get":
-            response = requests.get(url=url, params=params, json=json_payload, verify=False)
-        elif method == "delete":
-            response = requests.delete(url=url, params=params, json=json_payload, verify=False)
-        logging.info(msg=f"Response Status Code: {response.status_code}")
-        logging.info(msg=f"Response Content: {response.text}")
-
-        if response.ok and len(response.content) > 0:
-            return response.json()
-        elif not response.ok:
-            if len(response.content) == 0:
-                response_data = ""
-            else:
-                try:
-                    response_data = response.json()
-                except:
-                    response_data = response.text
+        self._log_request(method, url, json_payload)
+        response = self._session_methods[method](url=url, params=params, json=json_payload)
+        return self._handle_response(
+            ok=response.ok,
+            status_code=response.status_code,
+            reason=response.reason,
+            url=response.url,
+            content=response.text,
+            request_headers=dict(response.request.headers),
+            request_method=response.request.method,
+        )
+
+
+class AsyncIBKRSession(_IBKRSessionBase):
+    """Serves as an asyncio Session for the Interactive Brokers API.
+
+    Requests made from the same event loop share one pooled
+    `aiohttp.ClientSession`, so concurrent requests reuse the same TCP/TLS
+    connections. A `ClientSession` is bound to the loop it was created in, so
+    each loop gets its own, which is closed by `close()` or when the loop
+    cancels its remaining tasks on shutdown (as `asyncio.run` does).
+    """
 
-            error_dict = {
-                "error_code": response.status_code,
-                "error_reason": response.reason,
-                "response_url": response.url,
-                "response_body": response_data,
-                "response_request": dict(response.request.headers),
-                "response_method": response.request.method,
-            }
+    def __init__(self, url: str = "https://localhost:5000/v1/api/") -> None:
+        super().__init__(url)
+        self._client_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        self._closers: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+
+    def client_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._client_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=20, ssl=False)
+            session = aiohttp.ClientSession(connector=connector)
+            self._client_sessions[loop] = session
+            self._closers[loop] = loop.create_task(self._close_on_shutdown(loop, session))
+        return session
+
+    async def _close_on_shutdown(self, loop: asyncio.AbstractEventLoop, session: aiohttp.ClientSession) -> None:
+        try:
+            await loop.create_future()
+        finally:
+            if self._client_sessions.get(loop) is session:
+                del self._client_sessions[loop]
+                del self._closers[loop]
+            await session.close()
+
+    async def close(self) -> None:
+        closer = self._closers.get(asyncio.get_running_loop())
+        if closer is not None:
+            closer.cancel()
+            try:
+                await closer
+            except asyncio.CancelledError:
+                pass
+
+    async def __aenter__(self) -> "AsyncIBKRSession":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def get(self, endpoint: str, params: dict = None) -> Dict:
+        return await self.make_request("get", endpoint=endpoint, params=params)
+
+    async def post(self, endpoint: str, json_payload: dict = None) -> Dict:
+        return await self.make_request("post", endpoint=endpoint, json_payload=json_payload)
+
+    async def delete(self, endpoint: str, params: dict = None, json_payload: dict = None) -> Dict:
+        return await self.make_request("delete", endpoint=endpoint, params=params, json_payload=json_payload)
+
+    async def make_request(self, method: str, endpoint: str, params: dict = None, json_payload: dict = None) -> Dict:
+        """Async counterpart of `IBKRSession.make_request`."""
 
-            logging.error(msg=json.dumps(obj=error_dict, indent=4))
-            return error_dict
+        url = self.build_url(endpoint=endpoint)
+        self._log_request(method, url, json_payload)
+        session = self.client_session()
+        async with session.request(method, url, params=params, json=json_payload) as response:
+            content = await response.text()
+            return self._handle_response(
+                ok=response.ok,
+                status_code=response.status,
+                reason=response.reason,
+                url=str(response.url),
+                content=content,
+                request_headers=dict(response.request_info.headers),
+                request_method=response.request_info.method,
+            )
 
 class Field:
     LAST_PRICE = "31"
     MARKET_VALUE = "73"
     DATA_INFO = "6509"
     HAS_TRADING_PERMISSION = "7768"
+    ALL_FIELDS = ",".join([LAST_PRICE, MARKET_VALUE, DATA_INFO, HAS_TRADING_PERMISSION])
 
     @classmethod
-    def join(cls, **fields):
+    def join(cls, *fields):
         return ",".join(fields)
 
+@functools.lru_cache(maxsize=4096)
+def _resolve_symbol(symbol: str, session: IBKRSession) -> tuple[int, str, str]:
+    """Looks up the US `(conid, exchange, currency)` for a symbol, cached for the session's lifetime."""
+    params = {"symbols": symbol}
+    response = session.make_request(method="get", endpoint="trsrv/stocks", params=params)
+    if "error_code" in response:
+        raise Exception(response)
+    results = response[symbol]
+    for result in results:
+        for contract in result["contracts"]:
+            if contract["isUS"] is True:
+                return contract["conid"], contract["exchange"], contract["currency"]
+    raise Exception(f"Could not find stock with {symbol=} on a US exchange: {results}")
+
 class Stock:
     session = IBKRSession()
+    async_session = session.async_session
+    MIN_POLL_DELAY = 0.05
+    MAX_POLL_DELAY = 0.5
 
     def __init__(
-        self, symbol: str, conid: int = None, exchange: str = None, currency: str = None, session: IBKRSession = None
+        self,
+        symbol: str,
+        conid: int = None,
+        exchange: str = None,
+        currency: str = None,
+        session: IBKRSession = None,
+        async_session: AsyncIBKRSession = None,
     ):
         self.symbol = symbol
         self.conid = conid
@@ -143,51 +293,84 @@ class Stock:
         self.currency = currency
         if session is not None:
             self.session = session
+        if async_session is not None:
+            self.async_session = async_session
+        elif session is not None:
+            self.async_session = session.async_session
         if self.conid is None or self.exchange is None:
             self.complete_information()
         self.price = None
         self.price_updated = None
 
     @classmethod
-    def by_symbol(cls, symbol: str, session: IBKRSession = None):
-        session = cls.session if session is None else session
-        params = {"symbols": symbol}
-        response = session.make_request(method="get", endpoint="trsrv/stocks", params=params)
-        if "error_code" in response:
-            raise Exception(response)
-        results = response[symbol]
-        for result in results:
-            for contract in result["contracts"]:
-                if contract["isUS"] is True:
-                    return cls(
-                        symbol=symbol,
-                        conid=contract["conid"],
-                        exchange=contract["exchange"],
-                        currency=contract["currency"]
-                    )
-        raise Exception(f"Could not find stock with {symbol=} on a US exchange: {results}")
+    def by_symbol(cls, symbol: str, session: IBKRSession = None, async_session: AsyncIBKRSession = None):
+        conid, exchange, currency = _resolve_symbol(symbol, cls.session if session is None else session)
+        return cls(
+            symbol=symbol,
+            conid=conid,
+            exchange=exchange,
+            currency=currency,
+            session=session,
+            async_session=async_session,
+        )
 
     def complete_information(self):
-        stock = self.get_stock_by_symbol(symbol=self.symbol)
-        self.conid = stock.conid
-        self.exchange = stock.exchange
-
-    def update_latest_price(self, max_tries: int = 10):
-        self.session.get("/iserver/marketdata/snapshot", params={"conids": self.conid, "fields": Field.LAST_PRICE})
-        for i in range(10):
-            response = self.session.get("/iserver/marketdata/snapshot", params={"conids": self.conid})
+        conid, exchange, currency = _resolve_symbol(self.symbol, self.session)
+        self.conid = conid
+        self.exchange = exchange
+        if self.currency is None:
+            self.currency = currency
+
+    def is_price_fresh(self, ttl_seconds: float) -> bool:
+        return (
+            self.price is not None
+            and self.price_updated is not None
+            and time.time() - self.price_updated < ttl_seconds
+        )
+
+    def _set_price_from_snapshot(self, response: dict) -> float:
+        try:
+            price = response[Field.LAST_PRICE]
+            price_without_close_prefix = price.replace("C", "")
+            self.price = float(price_without_close_prefix)
+        except ValueError:
+            print(f"Problem getting price for {self.symbol=}: {response=}")
+            raise
+        self.price_updated = time.time()
+        return self.price
+
+    def update_latest_price(self, max_tries: int = 10, ttl_seconds: float = 5):
+        if self.is_price_fresh(ttl_seconds):
+            return self.price
+        if self.conid not in self.session.warmed_conids:
+            # the first snapshot for a conid only subscribes to the field and returns partial data
+            response = self.session.get("/iserver/marketdata/snapshot", params={"conids": self.conid, "fields": Field.LAST_PRICE})
+            if isinstance(response, list):
+                self.session.warmed_conids.add(self.conid)
+        delay = self.MIN_POLL_DELAY
+        for i in range(max_tries):
+            response = self.session.get("/iserver/marketdata/snapshot", params={"conids": self.conid, "fields": Field.LAST_PRICE})
             response = response[0]
             if Field.LAST_PRICE in response:
-                try:
-                    price = response[Field.LAST_PRICE]
-                    price_without_close_prefix = price.replace("C", "")
-                    self.price = float(price_without_close_prefix)
-                except ValueError:
-                    print(f"Problem getting price for {self.symbol=}: {response=}")
-                    raise
-                self.price_updated = time.time()
-                return self.price
-            time.sleep(0.5)
+                return self._set_price_from_snapshot(response)
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_POLL_DELAY)
+
+    async def update_latest_price_async(self, max_tries: int = 10, ttl_seconds: float = 5):
+        if self.is_price_fresh(ttl_seconds):
+            return self.price
+        if self.conid not in self.async_session.warmed_conids:
+            response = await self.async_session.get("/iserver/marketdata/snapshot", params={"conids": self.conid, "fields": Field.LAST_PRICE})
+            if isinstance(response, list):
+                self.async_session.warmed_conids.add(self.conid)
+        delay = self.MIN_POLL_DELAY
+        for i in range(max_tries):
+            response = await self.async_session.get("/iserver/marketdata/snapshot", params={"conids": self.conid, "fields": Field.LAST_PRICE})
+            response = response[0]
+            if Field.LAST_PRICE in response:
+                return self._set_price_from_snapshot(response)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_POLL_DELAY)
 
 
     def __repr__(self):
@@ -197,7 +380,7 @@ class Stock:
         price = self.price
         return f"Stock({symbol=}, {conid=}, {exchange=}, {price=})"
 
-@dataclass
+@dataclass(slots=True)
 class Position:
     stock: Stock
     num_shares: float
@@ -206,15 +389,27 @@ class Position:
 
 class Portfolio:
     session = IBKRSession()
+    async_session = session.async_session
 
-    def __init__(self, account_id: int, session: IBKRSession = None):
+    def __init__(self, account_id: int, session: IBKRSession = None, async_session: AsyncIBKRSession = None):
         self.session = self.session if session is None else session
+        if async_session is not None:
+            self.async_session = async_session
+        elif session is not None:
+            self.async_session = session.async_session
         self.account_id = account_id
         self.positions = []
+        self._by_symbol = {}
         self.update_positions()
 
     def update_positions(self) -> list[Position]:
         self.positions = self.update_positions_for_account(self.account_id)
+        self._by_symbol = {p.stock.symbol: p for p in self.positions}
+        return self.positions
+
+    async def update_positions_async(self, concurrency: int = 8) -> list[Position]:
+        self.positions = await self.update_positions_for_account_async(self.account_id, concurrency=concurrency)
+        self._by_symbol = {p.stock.symbol: p for p in self.positions}
         return self.positions
 
     def update_positions_for_account(self, account_id: int) -> list[Position]:
@@ -225,29 +420,85 @@ class Portfolio:
             result = self.session.get(f"/portfolio/{account_id}/positions/{page}")
             finished = result == []
             page += 1
-            for row in result:
-                if row["assetClass"] != "STK":
-                    continue
-                symbol = row.get("ticker", row["contractDesc"])
-                stock = Stock(symbol=symbol, conid=row["conid"], exchange=row["listingExchange"], currency=row["currency"])
-                position = self.get_position(stock=stock, create_if_needed=True)
-                position.num_shares = row["position"]
-                position.market_value = row["mktValue"]
-                positions.append(position)
+            positions.extend(self._positions_from_page(result))
+        return positions
+
+    async def update_positions_for_account_async(self, account_id: int, concurrency: int = 8) -> list[Position]:
+        start = 0
+        positions = []
+        while True:
+            results = await asyncio.gather(
+                *[self.async_session.get(f"/portfolio/{account_id}/positions/{page}") for page in range(start, start + concurrency)]
+            )
+            for result in results:
+                # pages after the first empty one are past the end of the account
+                if result == []:
+                    return positions
+                positions.extend(self._positions_from_page(result))
+            start += concurrency
+
+    def _positions_from_page(self, result: list[dict]) -> list[Position]:
+        positions = []
+        for row in result:
+            if row["assetClass"] != "STK":
+                continue
+            symbol = row.get("ticker", row["contractDesc"])
+            position = self._by_symbol.get(symbol)
+            if position is None:
+                stock = Stock(
+                    symbol=symbol,
+                    conid=row["conid"],
+                    exchange=row["listingExchange"],
+                    currency=row["currency"],
+                    session=self.session,
+                    async_session=self.async_session,
+                )
+                position = Position(stock, num_shares=0., market_value=0.)
+            position.num_shares = row["position"]
+            position.market_value = row["mktValue"]
+            positions.append(position)
         return positions
 
     def get_position(self, symbol: str = None, stock: Stock = None, create_if_needed: bool = False) -> Position:
         assert symbol is not None or stock is not None, f"Please provide a {symbol} or a {stock=}"
         symbol = stock.symbol if stock is not None else symbol
-        position = [p for p in self.positions if p.stock.symbol == symbol]
-        if len(position) == 0:
+        position = self._by_symbol.get(symbol)
+        if position is None:
             if create_if_needed is True:
-                stock = stock if stock is not None else Stock.by_symbol(symbol)
+                stock = stock if stock is not None else Stock.by_symbol(symbol, session=self.session, async_session=self.async_session)
                 return Position(stock, num_shares=0., market_value=0.)
-            raise Exception(f"You currently don't own any {sybmol=}")
-        position = position[0]
+            raise Exception(f"You currently don't own any {symbol=}")
         return position
 
+    def update_all_prices(self, max_tries: int = 10) -> list[Position]:
+        pending = {p.stock.conid: p.stock for p in self.positions}
+        if len(pending) == 0:
+            return self.positions
+        unwarmed = [conid for conid in pending if conid not in self.session.warmed_conids]
+        if len(unwarmed) > 0:
+            response = self.session.get("/iserver/marketdata/snapshot", params={"conids": ",".join(str(c) for c in unwarmed), "fields": Field.LAST_PRICE})
+            if isinstance(response, list):
+                self.session.warmed_conids.update(unwarmed)
+        delay = Stock.MIN_POLL_DELAY
+        for i in range(max_tries):
+            conids = ",".join(str(conid) for conid in pending)
+            response = self.session.get("/iserver/marketdata/snapshot", params={"conids": conids, "fields": Field.LAST_PRICE})
+            if response is None or "error_code" in response:
+                raise Exception(f"Could not get a market data snapshot for {conids=}: {response}")
+            for entry in response:
+                stock = pending.get(entry.get("conid"))
+                if stock is not None and Field.LAST_PRICE in entry:
+                    stock._set_price_from_snapshot(entry)
+                    del pending[stock.conid]
+            if len(pending) == 0 or i == max_tries - 1:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, Stock.MAX_POLL_DELAY)
+        return self.positions
+
+    async def refresh_prices_async(self) -> list[float]:
+        return await asyncio.gather(*[p.stock.update_latest_price_async() for p in self.positions])
+
     def set_allocation(self, symbol: str, allocation: float) -> Position:
         position = self.get_position(symbol, create_if_needed=True)
         position.allocation = allocation
@@ -1,10 +1,11 @@
 import csv
+import itertools
 import time
 import types
 import threading
-from functools import partial
-from typing import Callable, Union, List, Dict, Any
+from typing import Callable, Union, List, Dict, Any, Tuple
 
+import numpy as np
 from ibapi.client import EClient
 from ibapi.common import TickerId, MarketDataTypeEnum
 from ibapi.contract import Contract
@@ -12,47 +13,96 @@ from ibapi.ticktype import TickTypeEnum, TickType
 from ibapi.wrapper import EWrapper
 from dataclasses import dataclass
 
+from rebalance_kernel import compute_orders
+
+LAST = TickTypeEnum.LAST
+CLOSE = TickTypeEnum.CLOSE
+
 
 class Client(EWrapper, EClient):
     def __init__(self, port: int):
         EClient.__init__(self, self)
         self.run_thread = None
+        self.market_data_type = None
+        self.ready = threading.Event()
+        # indexed by request id, which are small sequential integers
+        self.market_data_functions: List[Callable] = []
         self.initialize_market_data_handlers()
         self.start(port=port)
-        self.market_data_functions = {}
 
     def register(self, function_name: str, function: Callable):
         setattr(self, function_name, types.MethodType(function, self))
 
-    def start(self, port: int, client_id: int = 1, host: str = "127.0.0.1"):
+    def start(
+        self, port: int, client_id: int = 1, host: str = "127.0.0.1", timeout: float = 5.0
+    ):
         def run_loop():
             self.run()
 
+        self.ready.clear()
         self.connect(host=host, port=port, clientId=client_id)
         self.run_thread = threading.Thread(target=run_loop, daemon=True)
         self.run_thread.start()
+        if not self.ready.wait(timeout=timeout):
+            self.disconnect()
+            raise TimeoutError(f"Connection to {host}:{port} was not ready after {timeout}s")
+        self.set_market_data_type(MarketDataTypeEnum.DELAYED_FROZEN)
         return self.run_thread
 
+    def disconnect(self):
+        super().disconnect()
+        # a new connection starts with IB's default market data type again
+        self.market_data_type = None
+        self.ready.clear()
+
+    def nextValidId(self, orderId: int):
+        super().nextValidId(orderId)
+        self.ready.set()
+
+    def set_market_data_type(self, market_data_type: int):
+        # the market data type is sticky for the session, so only send it when it changes
+        if market_data_type != self.market_data_type:
+            self.reqMarketDataType(market_data_type)
+            self.market_data_type = market_data_type
+
     def register_market_data_callback(self, request_id: int, function: Callable):
-        self.market_data_functions[request_id] = function
+        functions = self.market_data_functions
+        if request_id >= len(functions):
+            functions.extend([None] * (request_id + 1 - len(functions)))
+        functions[request_id] = function
+
+    def unregister_market_data_callback(self, request_id: int):
+        if request_id < len(self.market_data_functions):
+            self.market_data_functions[request_id] = None
 
     def initialize_market_data_handlers(self):
-        def handle_market_data(self, request_id: int, *args, **kwargs):
-            if request_id in self.market_data_functions:
-                self.market_data_functions[request_id](*args, **kwargs)
-
-        for fn in [
-            "tickPrice",
-            "tickSize",
-            "tickString",
-            "tickGeneric",
-            "tickEFP",
-            "tickOptionComputation",
-        ]:
+        def handle_tick_price(self, request_id: int, tick_type: int, price: float, attrib):
+            functions = self.market_data_functions
+            function = functions[request_id] if request_id < len(functions) else None
+            if function is not None:
+                function(tick_type, price, attrib)
+
+        def handle_tick_value(self, request_id: int, tick_type: int, value):
+            functions = self.market_data_functions
+            function = functions[request_id] if request_id < len(functions) else None
+            if function is not None:
+                function(tick_type, value)
+
+        def handle_market_data(self, request_id: int, *args):
+            functions = self.market_data_functions
+            function = functions[request_id] if request_id < len(functions) else None
+            if function is not None:
+                function(*args)
+
+        self.register(function_name="tickPrice", function=handle_tick_price)
+        for fn in ["tickSize", "tickString", "tickGeneric"]:
+            self.register(function_name=fn, function=handle_tick_value)
+        # these carry many (and version-dependent) fields, so they are passed through as-is
+        for fn in ["tickEFP", "tickOptionComputation"]:
             self.register(function_name=fn, function=handle_market_data)
 
 
-@dataclass
+@dataclass(slots=True)
 class Position:
     contract: Contract
     num_shares: float
@@ -63,14 +113,60 @@ class Position:
 class Portfolio:
     def __init__(self):
         self.positions = []
+        self._arrays = None
 
     def add_position(self, position: Position):
         self.positions.append(position)
+        self._arrays = None
+
+    def as_arrays(self) -> Dict[str, np.ndarray]:
+        # derived view of self.positions for vectorized math; holdings are cached until
+        # add_position, prices are rebuilt each call since they are updated in place
+        count = len(self.positions)
+        if self._arrays is None:
+            self._arrays = {
+                "num_shares": np.fromiter(
+                    (p.num_shares for p in self.positions), dtype=np.float64, count=count
+                ),
+                "conId": np.fromiter(
+                    (p.contract.conId for p in self.positions), dtype=np.int64, count=count
+                ),
+            }
+        return {
+            **self._arrays,
+            "current_price": np.fromiter(
+                (np.nan if p.current_price is None else p.current_price for p in self.positions),
+                dtype=np.float64,
+                count=count,
+            ),
+        }
+
+    def compute_orders(self, target_weights: np.ndarray, cash: float) -> np.ndarray:
+        arrays = self.as_arrays()
+        prices = arrays["current_price"]
+        # the compiled kernel does no bounds checking, so validate its inputs here
+        target_weights = np.asarray(target_weights, dtype=np.float64)
+        if target_weights.shape != prices.shape:
+            raise ValueError(
+                f"Expected {prices.shape[0]} target weights, got {target_weights.shape}"
+            )
+        if not (np.isfinite(prices).all() and (prices > 0).all()):
+            missing = [
+                p.contract.conId
+                for p, price in zip(self.positions, prices.tolist())
+                if not (np.isfinite(price) and price > 0)
+            ]
+            raise ValueError(f"Positions without a valid price: {missing}")
+        total_value = float((arrays["num_shares"] * prices).sum()) + cash
+        if not total_value > 0:
+            raise ValueError(f"Cannot rebalance a portfolio with total value {total_value}")
+        return compute_orders(arrays["num_shares"], prices, target_weights, cash)
 
 
 class PortfolioUpdater:
     def __init__(self, client: Client):
         self.client = client
+        self.market_data_getter = MarketDataGetter(client)
 
     def update_portfolio(self, portfolio: Portfolio, callback: Callable):
         def add_positions(positions: List[Position]):
@@ -102,29 +198,59 @@ class PortfolioUpdater:
         self.client.reqPositions()
 
     def get_price_for_position(self, position: Position, callback: Callable):
-        simple_contract = ContractBuilder.from_id(position.contract.conId)
-
-        def get_price(contract: Contract, tick_type_str: str, value: float):
-            if tick_type_str == "LAST" or tick_type_str == "CLOSE":
-                position.current_price = value
-                MarketDataGetter.cancel_contract_request(contract=contract)
-                callback(position)
+        self.get_price_for_contract_id(
+            contract_id=position.contract.conId,
+            positions=[position],
+            callback=lambda positions: callback(position),
+        )
 
-        MarketDataGetter(self.client).request_price_by_contract(
-            contract=simple_contract, callback=get_price
+    def get_price_for_contract_id(
+        self, contract_id: int, positions: List[Position], callback: Callable
+    ):
+        simple_contract = ContractBuilder.from_id(contract_id)
+        # allocated up front, since ticks can arrive before request_price_by_contract returns
+        request_id = self.market_data_getter.next_request_id()
+        done = [False]
+
+        def get_price(contract: Contract, tick_type: TickType, value: float):
+            if tick_type == LAST or tick_type == CLOSE:
+                # ticks queued before the cancel reaches IB must not complete twice
+                if done[0]:
+                    return
+                done[0] = True
+                for position in positions:
+                    position.current_price = value
+                self.market_data_getter.cancel_request(request_id, contract=contract)
+                callback(positions)
+
+        self.market_data_getter.request_price_by_contract(
+            contract=simple_contract, callback=get_price, request_id=request_id
         )
 
     def get_price_for_positions(self, positions: List[Position], callback: Callable):
-        positions_received = []
-
-        def all_positions_retrieved(position: Position):
-            positions_received.append(position)
-            if len(positions_received) == len(positions):
-                callback(positions_received)
-
+        positions_by_contract_id: Dict[int, List[Position]] = {}
         for position in positions:
-            self.get_price_for_position(
-                position=position, callback=all_positions_retrieved
+            positions_by_contract_id.setdefault(position.contract.conId, []).append(
+                position
+            )
+        if len(positions_by_contract_id) == 0:
+            callback(positions)
+            return
+        contracts_remaining = [len(positions_by_contract_id)]
+        lock = threading.Lock()
+
+        def contract_positions_retrieved(contract_positions: List[Position]):
+            with lock:
+                contracts_remaining[0] -= 1
+                finished = contracts_remaining[0] == 0
+            if finished:
+                callback(positions)
+
+        for contract_id, contract_positions in positions_by_contract_id.items():
+            self.get_price_for_contract_id(
+                contract_id=contract_id,
+                positions=contract_positions,
+                callback=contract_positions_retrieved,
             )
 
 
@@ -153,48 +279,85 @@ class ContractBuilder:
         contract.symbol = symbol
         contract.exchange = exchange
         contract.currency = currency
-        for k, v in kwargs.items():
-            setattr(contract, k, v)
+        if hasattr(contract, "__dict__"):
+            contract.__dict__.update(kwargs)
+        else:
+            for k, v in kwargs.items():
+                setattr(contract, k, v)
         return contract
 
 
 class MarketDataGetter:
-    def __init__(self, client: Client):
+    # ibapi only iterates the options, so one shared immutable empty value is enough
+    _EMPTY_OPTS: tuple = ()
+    # shared by all getters so that request ids never collide on a client
+    _next_id = itertools.count(1)
+    _id_lock = threading.Lock()
+
+    def __init__(self, client: Client, price_ttl: float = 2.0):
         self.client = client
-        self.request_id = 1
+        self.price_ttl = price_ttl
+        self._price_cache: Dict[tuple, Tuple[float, float]] = {}
+        self._subscribed_ids = set()
+        # only used to cancel every active request for a contract
+        self._active_ids_by_key: Dict[tuple, set] = {}
 
-    def get_id_from_contract(self, contract: Contract) -> int:
-        my_id = int(hash(contract) % 2**15)
-        return my_id
+    @staticmethod
+    def get_key_from_contract(contract: Contract) -> tuple:
+        return (contract.conId, contract.symbol, contract.secType, contract.exchange)
+
+    def next_request_id(self) -> int:
+        with self._id_lock:
+            return next(self._next_id)
 
     def request_price_by_contract(
-        self, contract: Contract, callback: Callable, timeout: float = 10.0
-    ):
-        my_id = self.get_id_from_contract(contract=contract)
+        self,
+        contract: Contract,
+        callback: Callable,
+        timeout: float = 10.0,
+        request_id: int = None,
+    ) -> int:
+        my_id = self.next_request_id() if request_id is None else request_id
+        key = self.get_key_from_contract(contract)
+        cached = self._price_cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] < self.price_ttl:
+            callback(contract, LAST, cached[0])
+            return my_id
 
         def get_result(tick_type: TickType, value, *args):
-            tick_type_str = TickTypeEnum.to_str(tick_type)
-            # if tick_type == TickTypeEnum.LAST or tick_type == TickTypeEnum.CLOSE:
-            callback(contract, tick_type_str, value)
-            # self.cancel_contract_request(contract=contract)
+            if tick_type == LAST or tick_type == CLOSE:
+                self._price_cache[key] = (value, time.monotonic())
+            callback(contract, tick_type, value)
 
         self.client.register_market_data_callback(request_id=my_id, function=get_result)
-        self.client.reqMarketDataType(MarketDataTypeEnum.DELAYED_FROZEN)
+        # recorded before subscribing, since the first tick may cancel before reqMktData returns
+        self._subscribed_ids.add(my_id)
+        self._active_ids_by_key.setdefault(key, set()).add(my_id)
         self.client.reqMktData(
             reqId=my_id,
             contract=contract,
             genericTickList="",
             snapshot=False,
             regulatorySnapshot=False,
-            mktDataOptions=[],
+            mktDataOptions=self._EMPTY_OPTS,
         )
+        return my_id
+
+    def cancel_request(self, request_id: int, contract: Contract = None):
+        if request_id in self._subscribed_ids:
+            self._subscribed_ids.discard(request_id)
+            if contract is not None:
+                self._active_ids_by_key.get(self.get_key_from_contract(contract), set()).discard(request_id)
+            self.client.cancelMktData(request_id)
+            self.client.unregister_market_data_callback(request_id)
 
     def cancel_contract_request(self, contract: Contract):
-        my_id = self.get_id_from_contract(contract=contract)
-        self.client.cancelMktData(my_id)
+        key = self.get_key_from_contract(contract)
+        for request_id in self._active_ids_by_key.pop(key, set()):
+            self.cancel_request(request_id)
 
 
-@dataclass
+@dataclass(slots=True)
 class Investment:
     symbol: str
     allocation: float
@@ -202,33 +365,29 @@ class Investment:
 
 class Plan:
     def __init__(self):
-        self.investments: List[Investment] = []
+        self._by_symbol: Dict[str, Investment] = {}
+
+    @property
+    def investments(self) -> List[Investment]:
+        return list(self._by_symbol.values())
 
     def add_investment(self, investment: Investment):
-        if investment not in self.investments:
-            self.investments.append(investment)
+        self._by_symbol.setdefault(investment.symbol, investment)
 
 
 class PlanReader:
     @classmethod
     def read_plan(cls, path: str) -> Plan:
         plan = Plan()
-        rows = cls._load_file(path)
-        for row in rows:
-            plan.add_investment(Investment(row["stock"], row["allocation"]))
-        return Plan
-
-    @classmethod
-    def _load_file(cls, path: str) -> List[Dict[Any, Any]]:
-        with open(path) as f:
-            dr = csv.DictReader(f)
-            return [row for row in dr]
+        with open(path, newline="", buffering=1 << 20) as f:
+            for row in csv.DictReader(f):
+                plan.add_investment(Investment(row["stock"], float(row["allocation"])))
+        return plan
 
 
 if __name__ == "__main__":
     PORT = 8888
     client = Client(port=PORT)
-    time.sleep(0.5)
     p = Portfolio()
     PortfolioUpdater(client).update_portfolio(
         portfolio=p, callback=lambda *args: print(args)